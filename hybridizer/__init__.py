@@ -11,4 +11,6 @@ Example Usage:
 hyb = Hybridizer('example_calibration.yaml','example_config.yaml')
 hyb.run_protocol()
 '''
-from hybridizer import Hybridizer, HybridizerError, main
+from hybridizer import Hybridizer, HybridizerError, load_files, main
+from job_queue import HybridizerJobQueue
+from sensor_archive import SensorArchive, SensorArchiveWriter
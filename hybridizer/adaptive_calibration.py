@@ -0,0 +1,149 @@
+from __future__ import print_function, division
+import os
+import time
+import numpy
+import yaml
+from numpy.polynomial.polynomial import Polynomial
+
+FORGETTING_FACTOR = 0.95
+INITIAL_COVARIANCE = 0.1
+MAX_COVARIANCE = 1.0
+MAX_CHANGE = 0.3
+OUTLIER_THRESHOLD = 0.5
+HISTORY_COUNT = 10
+GRID_POINT_COUNT = 20
+
+
+class AdaptiveFillCalibration(object):
+    '''
+    Learns each quad's volume_to_fill_duration polynomial online with
+    recursive least squares, using the total fill duration and the final
+    volume of every cylinder fill. The covariance is bounded so repeated
+    fills at the same volume do not wind it up. Updates are rejected when the sample
+    is an outlier, or when over the fill volume range the updated
+    polynomial would not be positive, would differ from the calibration
+    file by more than max_change, or would start decreasing where the
+    calibration file polynomial increases. The learned coefficients
+    are saved, with a version number and a short history, to file_path
+    and are only reused while the calibration file coefficients they
+    were learned from are unchanged, so a manual recalibration starts
+    over.
+    '''
+
+    def __init__(self,
+                 file_path,
+                 calibration,
+                 valve_keys,
+                 volume_min,
+                 volume_max,
+                 forgetting_factor=FORGETTING_FACTOR,
+                 max_change=MAX_CHANGE,
+                 outlier_threshold=OUTLIER_THRESHOLD):
+        self._file_path = file_path
+        self._volume_min = volume_min
+        self._volume_max = volume_max
+        self._forgetting_factor = forgetting_factor
+        self._max_change = max_change
+        self._outlier_threshold = outlier_threshold
+        self._volume_grid = numpy.linspace(volume_min,volume_max,GRID_POINT_COUNT)
+        self._covariance_initial = {}
+        saved = {}
+        if os.path.exists(file_path):
+            with open(file_path,'r') as adaptive_stream:
+                saved = yaml.safe_load(adaptive_stream) or {}
+        self._quads = {}
+        for valve_key in valve_keys:
+            base_coefficients = [float(c) for c in calibration[valve_key]['volume_to_fill_duration']]
+            scales = numpy.array([volume_max**power for power in range(len(base_coefficients))])
+            covariance_initial = numpy.diag(INITIAL_COVARIANCE/scales**2)
+            self._covariance_initial[valve_key] = covariance_initial
+            quad = saved.get(valve_key)
+            if (quad is None) or (quad['base_coefficients'] != base_coefficients):
+                quad = {'base_coefficients': base_coefficients,
+                        'coefficients': base_coefficients,
+                        'covariance': covariance_initial.tolist(),
+                        'version': 0,
+                        'sample_count': 0,
+                        'rejected_count': 0,
+                        'updated': None,
+                        'history': [],
+                        }
+            else:
+                quad['covariance'] = self._bound_covariance(valve_key,numpy.array(quad['covariance'])).tolist()
+            self._quads[valve_key] = quad
+
+    def get_coefficients(self,valve_key):
+        return list(self._quads[valve_key]['coefficients'])
+
+    def get_version(self,valve_key):
+        return self._quads[valve_key]['version']
+
+    def update(self,valve_key,volume,fill_duration):
+        '''
+        Update the valve fill duration model with a fill that reached
+        volume after the valve was open for a total of fill_duration ms.
+        Returns True if the update was accepted.
+        '''
+        quad = self._quads[valve_key]
+        if (volume is None) or (volume < self._volume_min) or (volume > self._volume_max) or (fill_duration <= 0):
+            return False
+        coefficients = numpy.array(quad['coefficients'])
+        covariance = numpy.array(quad['covariance'])
+        x = numpy.array([volume**power for power in range(len(coefficients))])
+        prediction = numpy.dot(x,coefficients)
+        error = fill_duration - prediction
+        if abs(error) > self._outlier_threshold*abs(prediction):
+            quad['rejected_count'] += 1
+            return False
+        covariance_x = numpy.dot(covariance,x)
+        gain = covariance_x/(self._forgetting_factor + numpy.dot(x,covariance_x))
+        coefficients_new = coefficients + gain*error
+        covariance_new = (covariance - numpy.outer(gain,covariance_x))/self._forgetting_factor
+        # fills at the same volume only excite one direction, forgetting
+        # would grow the covariance of the others without bound and the
+        # next fill at another volume would make a huge jump
+        covariance_new = self._bound_covariance(valve_key,covariance_new)
+        if not self._is_valid(quad['base_coefficients'],coefficients_new):
+            quad['rejected_count'] += 1
+            return False
+        quad['history'].append({'version': quad['version'],
+                                'coefficients': quad['coefficients'],
+                                'updated': quad['updated'],
+                                })
+        quad['history'] = quad['history'][-HISTORY_COUNT:]
+        quad['coefficients'] = coefficients_new.tolist()
+        quad['covariance'] = covariance_new.tolist()
+        quad['version'] += 1
+        quad['sample_count'] += 1
+        quad['updated'] = time.strftime("%Y-%m-%d %H:%M:%S")
+        return True
+
+    def _bound_covariance(self,valve_key,covariance):
+        covariance_initial = self._covariance_initial[valve_key]
+        # clamp eigenvalues in the basis where the initial covariance is INITIAL_COVARIANCE times identity
+        scales = 1/numpy.sqrt(numpy.diag(covariance_initial))
+        covariance_scaled = (covariance*scales[:,None])*scales[None,:]
+        covariance_scaled = (covariance_scaled + covariance_scaled.T)/2
+        eigenvalues,eigenvectors = numpy.linalg.eigh(covariance_scaled)
+        eigenvalues = numpy.clip(eigenvalues,0,MAX_COVARIANCE)
+        covariance_scaled = numpy.dot(eigenvectors*eigenvalues,eigenvectors.T)
+        return (covariance_scaled/scales[:,None])/scales[None,:]
+
+    def _is_valid(self,base_coefficients,coefficients):
+        base_durations = Polynomial(base_coefficients)(self._volume_grid)
+        durations = Polynomial(coefficients)(self._volume_grid)
+        if numpy.any(durations <= 0):
+            return False
+        if numpy.any((numpy.diff(durations) < 0) & (numpy.diff(base_durations) >= 0)):
+            return False
+        # small durations at low volumes are allowed the change of an average duration
+        change_max = self._max_change*numpy.maximum(numpy.abs(base_durations),numpy.mean(numpy.abs(base_durations)))
+        return numpy.all(numpy.abs(durations - base_durations) <= change_max)
+
+    def save(self):
+        file_path_tmp = self._file_path + '.tmp'
+        with open(file_path_tmp,'w') as adaptive_stream:
+            yaml.safe_dump(self._quads,adaptive_stream,default_flow_style=False)
+        if os.path.exists(self._file_path):
+            os.remove(self._file_path)
+        os.rename(file_path_tmp,self._file_path)
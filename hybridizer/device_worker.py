@@ -0,0 +1,149 @@
+from __future__ import print_function, division
+import heapq
+import itertools
+import sys
+import threading
+
+PRIORITY_VALVE = 0
+PRIORITY_COMMAND = 1
+PRIORITY_TELEMETRY = 2
+
+if sys.version_info[0] >= 3:
+    def _reraise(exc_info):
+        raise exc_info[1].with_traceback(exc_info[2])
+else:
+    # the three argument raise is a syntax error on python 3
+    exec('def _reraise(exc_info):\n    raise exc_info[0], exc_info[1], exc_info[2]\n')
+
+class DeviceFuture(object):
+    '''
+    Result of a command queued on a DeviceWorker.
+    '''
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def set_result(self,result):
+        self._result = result
+        self._event.set()
+
+    def set_exc_info(self,exc_info):
+        self._exc_info = exc_info
+        self._event.set()
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self,timeout=None):
+        if not self._event.wait(timeout):
+            raise RuntimeError('Timed out waiting for device command.')
+        if self._exc_info is not None:
+            # keep the worker thread traceback
+            _reraise(self._exc_info)
+        return self._result
+
+
+class DeviceWorker(object):
+    '''
+    Owns a serial device and runs its commands one at a time from a
+    single thread, in priority order and then in the order they were
+    submitted, so several threads can share the device safely. Queued
+    calls to a method in batch_methods with the same arguments are
+    answered by a single device call.
+    '''
+
+    def __init__(self,device,name=None,batch_methods=None):
+        self._device = device
+        if batch_methods is None:
+            batch_methods = []
+        self._batch_methods = set(batch_methods)
+        self._queue = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run,name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self,priority,method_name,*args,**kwargs):
+        future = DeviceFuture()
+        with self._condition:
+            if not self._running:
+                raise RuntimeError('Device worker is stopped.')
+            heapq.heappush(self._queue,(priority,next(self._counter),method_name,args,kwargs,future))
+            self._condition.notify()
+        return future
+
+    def call(self,priority,method_name,*args,**kwargs):
+        return self.submit(priority,method_name,*args,**kwargs).result()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and (len(self._queue) == 0):
+                    self._condition.wait()
+                if len(self._queue) == 0:
+                    return
+                priority,count,method_name,args,kwargs,future = heapq.heappop(self._queue)
+                futures = [future]
+                if method_name in self._batch_methods:
+                    queue = []
+                    for item in self._queue:
+                        if (item[2] == method_name) and (item[3] == args) and (item[4] == kwargs):
+                            futures.append(item[5])
+                        else:
+                            queue.append(item)
+                    if len(futures) > 1:
+                        heapq.heapify(queue)
+                        self._queue = queue
+            try:
+                result = getattr(self._device,method_name)(*args,**kwargs)
+            except Exception:
+                exc_info = sys.exc_info()
+                for future in futures:
+                    future.set_exc_info(exc_info)
+            else:
+                for future in futures:
+                    future.set_result(result)
+
+
+class DeviceProxy(object):
+    '''
+    Stands in for a device owned by a DeviceWorker. Calling a method on
+    the proxy queues it on the worker, with its priority looked up in
+    priorities by method name, and waits for the result.
+    '''
+
+    def __init__(self,worker,priorities=None,default_priority=PRIORITY_COMMAND):
+        self._worker = worker
+        if priorities is None:
+            priorities = {}
+        self._priorities = priorities
+        self._default_priority = default_priority
+
+    def __getattr__(self,method_name):
+        if method_name.startswith('_'):
+            raise AttributeError(method_name)
+        priority = self._priorities.get(method_name,self._default_priority)
+        def call(*args,**kwargs):
+            return self._worker.call(priority,method_name,*args,**kwargs)
+        call.__name__ = method_name
+        return call
+
+    def submit(self,method_name,*args,**kwargs):
+        '''
+        Queue a method call without waiting, returns a DeviceFuture.
+        '''
+        priority = self._priorities.get(method_name,self._default_priority)
+        return self._worker.submit(priority,method_name,*args,**kwargs)
+
+    def get_worker(self):
+        return self._worker
@@ -2,6 +2,13 @@ from __future__ import print_function, division
 from serial_device2 import find_serial_device_ports
 from modular_device import ModularDevices
 from bioshake_device import BioshakeDevice, BioshakeError
+from status_server import HybridizerStatus, StatusServer
+from job_queue import HybridizerJobQueue
+from scheduler import DeadlineScheduler
+from sensor_archive import SensorArchiveWriter
+from adaptive_calibration import AdaptiveFillCalibration
+from protocol_optimizer import optimize_protocol, get_protocol_chemicals
+from device_worker import DeviceWorker, DeviceProxy, PRIORITY_VALVE, PRIORITY_TELEMETRY
 from exceptions import Exception
 import os
 import time
@@ -12,6 +19,13 @@ import csv
 import copy
 import numpy
 import sys
+import hashlib
+import pickle
+import threading
+try:
+    from yaml import CLoader as YamlLoader
+except ImportError:
+    from yaml import Loader as YamlLoader
 
 try:
     from pkg_resources import get_distribution, DistributionNotFound
@@ -32,6 +46,46 @@ DEBUG = True
 BAUDRATE = 9600
 FILTER_PERIOD = 0.2
 MSC_TIMEOUT = 0.15
+BIOSHAKE_RETRY_DELAY = 0.5
+BIOSHAKE_POLL_PERIOD = 0.5
+BIOSHAKE_SHAKE_STATE_BOOTING = 99
+BIOSHAKE_SHAKE_STATE_NO_REPLY = -1
+FILL_JUMPS_MAX = 100
+FILL_DURATION_MAX = 300
+FILL_STALL_JUMPS = 8
+FILL_STALL_ADC_DELTA = 2
+SENSOR_ARCHIVE_FILE_SIZE = 64*1024*1024
+SENSOR_ARCHIVE_FILE_COUNT_MAX = 16
+SENSOR_ARCHIVE_PERIOD = FILTER_PERIOD
+TELEMETRY_PERIOD = 2
+MSC_PRIORITIES = {'set_channels_on': PRIORITY_VALVE,
+                  'set_channels_off': PRIORITY_VALVE,
+                  'set_channels_on_for': PRIORITY_VALVE,
+                  'remove_all_set_fors': PRIORITY_VALVE,
+                  'are_all_set_fors_complete': PRIORITY_VALVE,
+                  'get_analog_inputs_filtered': PRIORITY_TELEMETRY,
+                  }
+MSC_BATCH_METHODS = ['get_analog_inputs_filtered']
+BSC_PRIORITIES = {'get_temp_actual': PRIORITY_TELEMETRY,
+                  'get_error_list': PRIORITY_TELEMETRY,
+                  }
+BSC_BATCH_METHODS = ['get_temp_actual']
+FILE_CACHE_VERSION = 2
+PROTOCOL_DEFAULTS = {'prime_count': 1,
+                     'dispense_volume': 2,
+                     'dispense_volumes': None,
+                     'shake_speed': None,
+                     'shake_duration': None,
+                     'post_shake_duration': 0,
+                     'separate': False,
+                     'aspirate': True,
+                     'temperature': None,
+                     'repeat': 0,
+                     }
+CALIBRATION_POLYNOMIALS = ['volume_to_adc_low',
+                           'volume_to_adc_high',
+                           'volume_to_fill_duration']
+QUADS = ['quad1','quad2','quad3','quad4','quad5','quad6']
 
 class HybridizerError(Exception):
     def __init__(self,value):
@@ -40,6 +94,116 @@ class HybridizerError(Exception):
         return repr(self.value)
 
 
+_file_cache = {}
+
+def load_files(calibration_file_path,config_file_path,cache_dir=None):
+    '''
+    Parse, validate and precompute a calibration and config file pair.
+    Results are cached by the content hash of both files, in memory
+    and optionally as pickles in cache_dir, so reloading or validating
+    many protocol files only parses each distinct pair once. Returns a
+    dict with the keys config, calibration, valves, protocol,
+    optimization and polynomials. Unless the config sets
+    optimize_protocol to false, protocol is optimized by
+    optimize_protocol and optimization is its report. The caller gets
+    its own copy and may modify it.
+    '''
+    with open(calibration_file_path,'rb') as calibration_stream:
+        calibration_contents = calibration_stream.read()
+    with open(config_file_path,'rb') as config_stream:
+        config_contents = config_stream.read()
+    digest = hashlib.sha1()
+    digest.update(str(FILE_CACHE_VERSION).encode())
+    digest.update(calibration_contents)
+    digest.update(b'\0')
+    digest.update(config_contents)
+    key = digest.hexdigest()
+    try:
+        files = _file_cache[key]
+    except KeyError:
+        files = None
+        cache_file_path = None
+        if cache_dir is not None:
+            cache_file_path = os.path.join(cache_dir,key + '.pickle')
+            try:
+                with open(cache_file_path,'rb') as cache_stream:
+                    files = pickle.load(cache_stream)
+            except (IOError,OSError,EOFError,pickle.UnpicklingError):
+                files = None
+        if files is None:
+            files = _parse_files(calibration_contents,config_contents)
+            if cache_file_path is not None:
+                try:
+                    if not os.path.isdir(cache_dir):
+                        os.makedirs(cache_dir)
+                    with open(cache_file_path,'wb') as cache_stream:
+                        pickle.dump(files,cache_stream,pickle.HIGHEST_PROTOCOL)
+                except (IOError,OSError):
+                    pass
+        _file_cache[key] = files
+    return copy.deepcopy(files)
+
+def _parse_files(calibration_contents,config_contents):
+    calibration = yaml.load(calibration_contents,Loader=YamlLoader)
+    config = yaml.load(config_contents,Loader=YamlLoader)
+    # check to see if user switched config and calibration files
+    if ('head' in calibration) and ('quad1' in config):
+        calibration,config = config,calibration
+    for key in ['head','manifold','protocol']:
+        if key not in config:
+            raise HybridizerError(key + ' is missing from the config file!')
+    valves = copy.copy(config['head'])
+    valves.update(config['manifold'])
+    protocol = []
+    for step_n,chemical_info in enumerate(config['protocol']):
+        step = copy.copy(PROTOCOL_DEFAULTS)
+        step.update(chemical_info)
+        try:
+            chemical = step['chemical']
+        except KeyError:
+            raise HybridizerError('Protocol step {0} is missing a chemical!'.format(step_n+1))
+        if chemical not in config['manifold']:
+            raise HybridizerError(str(chemical) + ' is not listed as part of the manifold in the config file!')
+        dispense_volumes = step['dispense_volumes'] or {}
+        for valve_key in dispense_volumes:
+            if (valve_key not in QUADS) or (valve_key not in valves):
+                raise HybridizerError('Protocol step {0} dispense_volumes has unknown quad {1}!'.format(step_n+1,valve_key))
+        step['dispense_volumes'] = {}
+        for valve_key in QUADS:
+            if valve_key in valves:
+                step['dispense_volumes'][valve_key] = dispense_volumes.get(valve_key,step['dispense_volume'])
+        for valve_key,dispense_volume in step['dispense_volumes'].items():
+            if dispense_volume < 0:
+                raise HybridizerError('Protocol step {0} asks for a negative volume for {1}!'.format(step_n+1,valve_key))
+            if ('volume_max' in config) and (dispense_volume > config['volume_max']):
+                raise HybridizerError('Protocol step {0} asks for volume greater than the max volume of {1}!'.format(step_n+1,config['volume_max']))
+        if step['repeat'] < 0:
+            step['repeat'] = 0
+        protocol.append(step)
+    optimization = None
+    if config.get('optimize_protocol',True):
+        protocol,optimization = optimize_protocol(protocol,config)
+    polynomials = {}
+    for valve_key in QUADS:
+        if valve_key not in valves:
+            continue
+        try:
+            valve_calibration = calibration[valve_key]
+        except (KeyError,TypeError):
+            raise HybridizerError(valve_key + ' is missing from the calibration file!')
+        polynomials[valve_key] = {}
+        for name in CALIBRATION_POLYNOMIALS:
+            if name in valve_calibration:
+                polynomials[valve_key][name] = Polynomial(valve_calibration[name])
+    return {'config': config,
+            'calibration': calibration,
+            'valves': valves,
+            'protocol': protocol,
+            'optimization': optimization,
+            'polynomials': polynomials,
+            }
+
+
 class Hybridizer(object):
     '''
     This Python package (hybridizer) creates a class named Hybridizer to
@@ -61,6 +225,11 @@ class Hybridizer(object):
                  mixed_signal_controller=True,
                  bioshake_device=True,
                  debug_msc=False,
+                 cache_dir=None,
+                 status_port=None,
+                 sensor_archive_dir=None,
+                 adaptive_calibration_file_path=None,
+                 sensor_archive_file_count_max=None,
                  *args,**kwargs):
         if 'debug' in kwargs:
             self._debug = kwargs['debug']
@@ -69,17 +238,38 @@ class Hybridizer(object):
             self._debug = DEBUG
         self._using_msc = mixed_signal_controller
         self._using_bsc = bioshake_device
-        with open(calibration_file_path,'r') as calibration_stream:
-            self._calibration = yaml.load(calibration_stream)
-        with open(config_file_path,'r') as config_stream:
-            self._config = yaml.load(config_stream)
-        # check to see if user switched config and calibration files
-        if ('head' in self._calibration) and ('quad1' in self._config):
-            calibration = self._config
-            self._config = self._calibration
-            self._calibration = calibration
-        self._valves = self._config['head']
-        self._valves.update(self._config['manifold'])
+        self._calibration_file_path = calibration_file_path
+        self._cache_dir = cache_dir
+        self._adaptive_calibration = None
+        self.load_config(config_file_path)
+        if adaptive_calibration_file_path is not None:
+            self._adaptive_calibration = AdaptiveFillCalibration(adaptive_calibration_file_path,
+                                                                 self._calibration,
+                                                                 sorted(self._polynomials.keys()),
+                                                                 self._config['volume_threshold_initial']/2,
+                                                                 self._config['volume_crossover'])
+            self._apply_adaptive_calibration()
+        self._valves_on = set()
+        self._known_state = False
+        self._overlap_prime = None
+        self._primed = None
+        self._bioshake_recoveries = []
+        self._fill_faults = []
+        self._scheduler = DeadlineScheduler()
+        self._phase = None
+        self._sensor_archive = None
+        if sensor_archive_dir is not None:
+            if sensor_archive_file_count_max is None:
+                sensor_archive_file_count_max = self._config.get('sensor_archive_file_count_max',SENSOR_ARCHIVE_FILE_COUNT_MAX)
+            self._sensor_archive = SensorArchiveWriter(sensor_archive_dir,
+                                                       self._config.get('sensor_archive_file_size',SENSOR_ARCHIVE_FILE_SIZE),
+                                                       sensor_archive_file_count_max)
+        self._status = HybridizerStatus()
+        self._status_server = None
+        if status_port is not None:
+            self._status_server = StatusServer(self._status,port=status_port)
+            self._status_server.start()
+            self._debug_print('Serving status on port ' + str(self._status_server.get_address()[1]))
         if self._using_msc or self._using_bsc:
             ports = find_serial_device_ports(debug=self._debug)
             self._debug_print('Found serial devices on ports ' + str(ports))
@@ -105,20 +295,134 @@ class Hybridizer(object):
                 raise HybridizerError('More than one mixed_signal_controller found. Only one should be connected.')
             self._msc = msc_dict[msc_dict.keys()[0]]
             self._debug_print('Found mixed_signal_controller on port ' + str(self._msc.get_port()))
+        # a single worker thread owns each serial device so other threads can share it
+        if self._using_bsc:
+            self._bsc = DeviceProxy(DeviceWorker(self._bsc,'bioshake_device',BSC_BATCH_METHODS),BSC_PRIORITIES)
+        if self._using_msc:
+            self._msc = DeviceProxy(DeviceWorker(self._msc,'mixed_signal_controller',MSC_BATCH_METHODS),MSC_PRIORITIES)
+        self._telemetry_thread = None
+        if (self._status_server is not None) and self._using_bsc:
+            self._telemetry_stop = threading.Event()
+            self._telemetry_thread = threading.Thread(target=self._poll_telemetry)
+            self._telemetry_thread.daemon = True
+            self._telemetry_thread.start()
+        self._sensor_archive_thread = None
+        if (self._sensor_archive is not None) and self._using_msc:
+            self._sensor_archive_stop = threading.Event()
+            self._sensor_archive_thread = threading.Thread(target=self._archive_sensors)
+            self._sensor_archive_thread.daemon = True
+            self._sensor_archive_thread.start()
+
+    def close(self):
+        '''
+        Stop the status server, the telemetry and sensor archive threads
+        and the device worker threads.
+        '''
+        if self._telemetry_thread is not None:
+            self._telemetry_stop.set()
+            self._telemetry_thread.join()
+            self._telemetry_thread = None
+        if self._sensor_archive_thread is not None:
+            self._sensor_archive_stop.set()
+            self._sensor_archive_thread.join()
+            self._sensor_archive_thread = None
+        if self._sensor_archive is not None:
+            self._sensor_archive.close()
+        self.stop_status_server()
+        for device in [getattr(self,'_msc',None),getattr(self,'_bsc',None)]:
+            if isinstance(device,DeviceProxy):
+                device.get_worker().stop()
+
+    def _poll_telemetry(self):
+        while not self._telemetry_stop.wait(TELEMETRY_PERIOD):
+            try:
+                self._status.update(temperature_actual=self._bsc.get_temp_actual())
+            except BioshakeError:
+                pass
+            except Exception as e:
+                # a serial error must not stop telemetry for the rest of the run
+                self._debug_print('telemetry read failed: ' + str(e))
+
+    def _archive_sensors(self):
+        '''
+        Archive the analog inputs every SENSOR_ARCHIVE_PERIOD seconds,
+        tagged with the current phase, for the whole time the hybridizer
+        is open and not only while cylinders fill. The
+        mixed_signal_controller only reports its own filtered values, so
+        these are archived rather than raw adc frames. Fill loop reads
+        queued at the same time share the same device call.
+        '''
+        while not self._sensor_archive_stop.wait(SENSOR_ARCHIVE_PERIOD):
+            try:
+                sample_values = self._msc.get_analog_inputs_filtered()
+                phase = self._phase
+                if phase is None:
+                    phase = 'idle'
+                self._sensor_archive.append(sample_values,phase)
+            except Exception as e:
+                self._debug_print('sensor archive read failed: ' + str(e))
+
+    def load_config(self,config_file_path):
+        '''
+        Load a new config file, keeping the calibration file and the open
+        device connections, so several protocols can be run in turn.
+        '''
+        files = load_files(self._calibration_file_path,config_file_path,self._cache_dir)
+        self._calibration = files['calibration']
+        self._config = files['config']
+        self._valves = files['valves']
+        self._protocol = files['protocol']
+        self._optimization = files['optimization']
+        self._polynomials = files['polynomials']
+        self._apply_adaptive_calibration()
+
+    def _apply_adaptive_calibration(self):
+        if self._adaptive_calibration is not None:
+            for valve_key in self._polynomials:
+                coefficients = self._adaptive_calibration.get_coefficients(valve_key)
+                self._polynomials[valve_key]['volume_to_fill_duration'] = Polynomial(coefficients)
+
+    def _update_adaptive_calibration(self,fill_volumes,fill_durations):
+        updated = False
+        for valve_key in fill_durations:
+            volume = self._adc_to_volume_low(valve_key,fill_volumes[valve_key])
+            if self._adaptive_calibration.update(valve_key,volume,fill_durations[valve_key]):
+                coefficients = self._adaptive_calibration.get_coefficients(valve_key)
+                self._polynomials[valve_key]['volume_to_fill_duration'] = Polynomial(coefficients)
+                self._debug_print('{0} volume_to_fill_duration updated to version {1}: {2}'.format(valve_key,
+                                                                                                  self._adaptive_calibration.get_version(valve_key),
+                                                                                                  coefficients))
+                updated = True
+        if updated:
+            self._adaptive_calibration.save()
+
+    def validate_config(self,config_file_path):
+        load_files(self._calibration_file_path,config_file_path,self._cache_dir)
+
+    def get_status(self):
+        return self._status.snapshot()
+
+    def stop_status_server(self):
+        if self._status_server is not None:
+            self._status_server.stop()
+            self._status_server = None
 
     def _setup(self):
+        self._set_phase('setup')
         if self._using_bsc:
             self._bsc.reset_device()
         self._set_all_valves_off()
         self._set_valves_on(['primer','quad1','quad2','quad3','quad4','quad5','quad6'])
         self._debug_print('setting up for ' + str(self._config['setup_duration']) + 's...')
-        time.sleep(self._config['setup_duration'])
+        self._scheduler.wait(self._config['setup_duration'],'setup')
         self._set_all_valves_off()
         self._debug_print('setup finished!')
 
     def prime_system(self):
+        self._scheduler.start()
         self._setup()
         self._debug_print('priming system...')
+        self._status.update(state='priming')
         manifold = self._config['manifold']
         chemicals = manifold.keys()
         try:
@@ -129,84 +433,195 @@ class Hybridizer(object):
             chemicals.remove('separate')
         except ValueError:
             pass
+        if self._optimization is not None:
+            protocol_chemicals = get_protocol_chemicals(self._protocol)
+            chemicals = [chemical for chemical in chemicals if chemical in protocol_chemicals]
+            self._debug_print('not priming chemicals unused by the protocol: ' + str(self._optimization['chemicals_unused']))
         self._set_valves_on(['separate','aspirate'])
         for chemical in chemicals:
             self._prime_chemical(chemical,self._config['system_prime_count'])
         self._set_all_valves_off()
+        self._known_state = True
+        self._primed = None
+        self._phase = None
+        self._status.update(state='idle',phase=None)
         self._debug_print('priming finished!')
 
-    def run_protocol(self):
-        self._setup()
+    def run_protocol(self,next_config_file_path=None):
+        '''
+        Run the protocol in the config file. Setup is skipped when the
+        previous run or prime finished with all valves off. When
+        next_config_file_path is given, the first chemical of the next
+        protocol is primed during the first shake or post shake wait of
+        the final step of this protocol that the prime fits in, or else
+        while it aspirates, and is not primed again by the next run.
+        '''
+        self._fill_faults = []
+        self._status.update(state='running',
+                            step=None,
+                            step_count=len(self._protocol),
+                            fill_faults=[],
+                            protocol_start_time=time.time(),
+                            planned_end_time=time.time() + self.estimate_protocol_duration())
+        self._scheduler.start()
+        if self._known_state:
+            self._debug_print('valves in known state, skipping setup...')
+        else:
+            self._setup()
+        self._known_state = False
+        primed = self._primed
+        self._primed = None
+        self._overlap_prime = None
         self.protocol_start_time = time.time()
         self._debug_print('running protocol...')
+        if self._optimization is not None:
+            self._debug_print('protocol optimization: ' + str(self._optimization))
         self._set_valves_on(['separate','aspirate'])
-        for chemical_info in self._config['protocol']:
-            chemical = chemical_info['chemical']
-            try:
-                prime_count = chemical_info['prime_count']
-            except KeyError:
-                prime_count = 1
-            try:
-                dispense_volume = chemical_info['dispense_volume']
-            except KeyError:
-                dispense_volume = 2
-            try:
-                shake_speed = chemical_info['shake_speed']
-            except KeyError:
-                shake_speed = None
-            try:
-                shake_duration = chemical_info['shake_duration']
-            except KeyError:
-                shake_duration = None
-            try:
-                post_shake_duration = chemical_info['post_shake_duration']
-            except KeyError:
-                post_shake_duration = 0
-            try:
-                separate = chemical_info['separate']
-            except KeyError:
-                separate = False
-            try:
-                aspirate = chemical_info['aspirate']
-            except KeyError:
-                aspirate = True
-            try:
-                temperature = chemical_info['temperature']
-            except KeyError:
-                temperature = None
-            try:
-                repeat = chemical_info['repeat']
-            except KeyError:
-                repeat = 0
-            self._run_chemical(chemical,
+        for step_n,step in enumerate(self._protocol):
+            prime_count = step['prime_count']
+            if (step_n == 0) and (primed is not None) and (primed[0] == step['chemical']):
+                prime_count = max(prime_count - primed[1],0)
+                self._debug_print(step['chemical'] + ' already primed ' + str(primed[1]) + ' times during the previous protocol')
+            if (step_n == (len(self._protocol) - 1)) and (next_config_file_path is not None):
+                self._overlap_prime = self._get_overlap_prime(next_config_file_path)
+            planned_end_time = time.time()
+            for remaining_step in self._protocol[step_n:]:
+                planned_end_time += self._estimate_step_duration(remaining_step)
+            self._status.update(step=step_n+1,
+                                chemical=step['chemical'],
+                                planned_end_time=planned_end_time)
+            self._run_chemical(step['chemical'],
                                prime_count,
-                               dispense_volume,
-                               shake_speed,
-                               shake_duration,
-                               post_shake_duration,
-                               separate,
-                               aspirate,
-                               temperature,
-                               repeat)
+                               step['dispense_volume'],
+                               step['shake_speed'],
+                               step['shake_duration'],
+                               step['post_shake_duration'],
+                               step['separate'],
+                               step['aspirate'],
+                               step['temperature'],
+                               step['repeat'],
+                               step['dispense_volumes'])
         self._set_all_valves_off()
+        self._known_state = True
+        if self._overlap_prime is not None:
+            self._debug_print('next protocol chemical ' + self._overlap_prime[0] + ' not primed early, the final step has no aspirate and no shake or post shake wait long enough')
+        self._overlap_prime = None
         self.protocol_end_time = time.time()
         protocol_run_time = self.protocol_end_time - self.protocol_start_time
+        self._phase = None
+        self._status.update(state='finished',phase=None,planned_end_time=self.protocol_end_time)
+        if self._sensor_archive is not None:
+            self._sensor_archive.flush()
         self._debug_print('protocol finished! it took ' + str(round(protocol_run_time/60)) + ' mins to run.')
+        if self._fill_faults:
+            self._debug_print('fill faults: ' + str(self._fill_faults))
+        if self._bioshake_recoveries:
+            self._debug_print('bioshake_device recoveries: ' + str(self.get_bioshake_recovery_stats()))
+        self._print_timing_report()
+
+    def get_timing_report(self):
+        '''
+        Returns the planned versus actual timing of the last protocol run,
+        see DeadlineScheduler.get_report.
+        '''
+        return self._scheduler.get_report()
+
+    def _print_timing_report(self):
+        timing_report = self.get_timing_report()
+        self._debug_print('planned: {0:.1f}s, unplanned: {1:.1f}s, actual: {2:.1f}s, drift: {3:.3f}s'.format(timing_report['planned'],
+                                                                                                            timing_report['unplanned'],
+                                                                                                            timing_report['elapsed'],
+                                                                                                            timing_report['drift']))
+        if not timing_report['monotonic']:
+            self._debug_print('no monotonic clock available, timing used the system clock')
+        for phase in sorted(timing_report['phases']):
+            phase_timing = timing_report['phases'][phase]
+            self._debug_print('{0}: {1} waits, planned: {2:.1f}s, jitter mean: {3:.4f}s, jitter max: {4:.4f}s'.format(phase,
+                                                                                                                     phase_timing['count'],
+                                                                                                                     phase_timing['planned'],
+                                                                                                                     phase_timing['jitter_mean'],
+                                                                                                                     phase_timing['jitter_max']))
+
+    def _get_overlap_prime(self,next_config_file_path):
+        next_files = load_files(self._calibration_file_path,next_config_file_path,self._cache_dir)
+        if len(next_files['protocol']) == 0:
+            return None
+        next_step = next_files['protocol'][0]
+        chemical = next_step['chemical']
+        if (next_step['prime_count'] <= 0) or (chemical not in self._config['manifold']):
+            return None
+        if next_files['valves'][chemical]['channel'] != self._valves[chemical]['channel']:
+            return None
+        return (chemical,next_step['prime_count'])
+
+    def estimate_protocol_duration(self):
+        '''
+        Returns the planned protocol duration in seconds, not counting
+        cylinder fill feedback or waiting for temperature.
+        '''
+        duration = self._config['setup_duration']
+        for step in self._protocol:
+            duration += self._estimate_step_duration(step)
+        return duration
+
+    def _estimate_step_duration(self,step):
+        config = self._config
+        duration = step['prime_count']*(config['prime_duration'] + config['prime_aspirate_duration'])
+        run_duration = 0
+        dispense_volume_max = max(list(step['dispense_volumes'].values()) or [step['dispense_volume']])
+        if dispense_volume_max > 0:
+            run_duration += config['pre_cylinder_fill_duration'] + config['post_cylinder_fill_duration'] + config['dispense_duration_full']
+        if dispense_volume_max > config['volume_crossover']:
+            run_duration += config['load_duration_full']
+        if not ((step['shake_duration'] is None) or (step['shake_duration'] <= 0)):
+            run_duration += max(step['shake_duration'],config['shake_duration_min']) + config['post_shake_off_duration']
+        run_duration += step['post_shake_duration']
+        if step['separate']:
+            run_duration += config['chemical_separate_duration'] + config['post_shake_off_duration']
+        if step['aspirate']:
+            run_duration += config['chemical_aspirate_duration'] + config['post_shake_off_duration']
+        duration += (max(step['repeat'],0) + 1)*run_duration
+        return duration
 
     def _prime_chemical(self,chemical,prime_count):
         if prime_count > 0:
             self._set_valve_on(chemical)
+            self._set_phase('priming')
         for i in range(prime_count):
             self._set_valves_on(['primer','system'])
             self._debug_print('priming ' + chemical + ' for ' + str(self._config['prime_duration']) + 's ' + str(i+1) + '/' + str(prime_count) + '...')
-            time.sleep(self._config['prime_duration'])
+            self._scheduler.wait(self._config['prime_duration'],'priming')
             self._set_valves_off(['system'])
             self._debug_print('emptying ' + chemical + ' for ' + str(self._config['prime_aspirate_duration']) + 's ' + str(i+1) + '/' + str(prime_count) + '...')
-            time.sleep(self._config['prime_aspirate_duration'])
+            self._scheduler.wait(self._config['prime_aspirate_duration'],'emptying')
             self._set_valve_off('primer')
         if prime_count > 0:
             self._set_valve_off(chemical)
 
+    def _wait_overlapping_prime(self,chemical,duration,phase,final_run,extend=False):
+        '''
+        Wait duration seconds in phase. In the final run of the last
+        step, the first chemical of the next protocol is primed during
+        the wait when the prime fits in it, or when extend is True, in
+        which case the wait lasts at least until the prime finishes.
+        '''
+        if final_run and (self._overlap_prime is not None):
+            next_chemical,next_prime_count = self._overlap_prime
+            prime_duration = next_prime_count*(self._config['prime_duration'] + self._config['prime_aspirate_duration'])
+            if extend or (prime_duration <= duration):
+                self._overlap_prime = None
+                self._scheduler.resync(phase)
+                deadline = self._scheduler.get_deadline() + duration
+                self._set_valve_off(chemical)
+                self._debug_print('priming next protocol chemical ' + next_chemical + ' during ' + phase + '...')
+                self._prime_chemical(next_chemical,next_prime_count)
+                self._primed = (next_chemical,next_prime_count)
+                self._set_phase(phase)
+                duration = deadline - self._scheduler.get_deadline()
+                if duration <= 0:
+                    return
+        self._scheduler.wait(duration,phase)
+
     def _run_chemical(self,
                       chemical,
                       prime_count=1,
@@ -217,7 +632,8 @@ class Hybridizer(object):
                       separate=False,
                       aspirate=True,
                       temp_target=None,
-                      repeat=0):
+                      repeat=0,
+                      dispense_volumes=None):
         if (chemical not in self._valves):
             raise HybridizerError(chemical + ' is not listed as part of the manifold in the config file!')
         if repeat < 0:
@@ -225,22 +641,33 @@ class Hybridizer(object):
         run_count = repeat + 1
         if self._using_bsc and (temp_target is not None):
             self._debug_print('turning on temperature control for ' + chemical + '...')
+            self._set_phase('heating')
             self._bsc.temp_on(temp_target)
             temp_actual = self._bsc.get_temp_actual()
+            self._status.update(temperature_target=temp_target,temperature_actual=temp_actual)
             self._debug_print('actual temperature: ' + str(temp_actual) + ', target temperature: ' + str(temp_target))
             while abs(temp_target - temp_actual) > 0.5:
                 time.sleep(1)
                 temp_actual = self._bsc.get_temp_actual()
+                self._status.update(temperature_actual=temp_actual)
                 self._debug_print('actual temperature: ' + str(temp_actual) + ', target temperature: ' + str(temp_target))
+            self._scheduler.resync('heating')
             self._debug_print()
         self._prime_chemical(chemical,prime_count)
         for run in range(run_count):
             self._debug_print('running ' + chemical + ' ' + str(run+1) + '/' + str(run_count) + '...')
+            self._status.update(run=run+1,run_count=run_count)
             self._set_valve_on(chemical)
             self._set_valve_on('aspirate')
             # self._set_valves_on(['quad1','quad2','quad3','quad4','quad5','quad6','aspirate'])
-            valves = ['quad1','quad2','quad3','quad4','quad5','quad6']
-            self._dispense_volume(valves,dispense_volume)
+            if dispense_volumes is None:
+                valves = QUADS
+                volumes = dispense_volume
+            else:
+                valves = [valve_key for valve_key in QUADS if dispense_volumes.get(valve_key,0) > 0]
+                volumes = [dispense_volumes[valve_key] for valve_key in valves]
+            if len(valves) > 0:
+                self._dispense_volume(valves,volumes)
             # for i in range(dispense_volume):
             #     if i > 0:
             #         dispense_shake_duration = self._config['inter_dispense_shake_duration']
@@ -262,24 +689,31 @@ class Hybridizer(object):
                 if shake_duration < self._config['shake_duration_min']:
                     actual_shake_duration = self._config['shake_duration_min']
                 actual_shake_speed = self._shake_on(shake_speed)
+                self._set_phase('shaking')
                 self._debug_print('shaking at ' + str(actual_shake_speed) + 'rpm for ' + str(actual_shake_duration) + 's...')
-                time.sleep(actual_shake_duration)
+                self._wait_overlapping_prime(chemical,actual_shake_duration,'shaking',run == (run_count - 1))
                 self._shake_off(actual_shake_speed)
             if (post_shake_duration > 0):
+                self._set_phase('post shake')
                 self._debug_print('waiting post shake for ' + str(post_shake_duration) + 's...')
-                time.sleep(post_shake_duration)
+                self._wait_overlapping_prime(chemical,post_shake_duration,'post shake',run == (run_count - 1))
             if separate:
                 separate_shake_speed = self._shake_on(self._config['separate_shake_speed'])
                 self._set_valve_off('separate')
+                self._set_phase('separating')
                 self._debug_print('separating ' + chemical + ' for ' + str(self._config['chemical_separate_duration']) + 's...')
-                time.sleep(self._config['chemical_separate_duration'])
+                self._scheduler.wait(self._config['chemical_separate_duration'],'separating')
                 self._set_valve_on('separate')
                 self._shake_off(separate_shake_speed)
             if aspirate:
                 aspirate_shake_speed = self._shake_on(self._config['aspirate_shake_speed'])
                 self._set_valve_off('aspirate')
+                self._set_phase('aspirating')
                 self._debug_print('aspirating ' + chemical + ' from microplate for ' + str(self._config['chemical_aspirate_duration']) + 's...')
-                time.sleep(self._config['chemical_aspirate_duration'])
+                # a late start, e.g. after a bioshake recovery, must not shorten aspiration
+                self._scheduler.resync('aspirating')
+                # aspirating longer than planned is harmless, so the prime does not have to fit
+                self._wait_overlapping_prime(chemical,self._config['chemical_aspirate_duration'],'aspirating',run == (run_count - 1),True)
                 self._set_valve_on('aspirate')
                 self._shake_off(aspirate_shake_speed)
             self._set_valve_off(chemical)
@@ -291,6 +725,7 @@ class Hybridizer(object):
                 self._bsc.temp_off()
             except BioshakeError:
                 pass
+            self._status.update(temperature_target=None)
             self._debug_print()
 
     def _shake_on(self,shake_speed):
@@ -300,36 +735,122 @@ class Hybridizer(object):
             elif shake_speed > self._SHAKE_SPEED_MAX:
                 shake_speed = self._SHAKE_SPEED_MAX
             if shake_speed != 0:
-                shook = False
-                shake_try = 0
-                while (not shook) and (shake_try < self._config['shake_attempts']):
-                    shake_try += 1
-                    try:
-                        self._bsc.shake_on(shake_speed)
-                        shook = True
-                    except BioshakeError:
-                        self._debug_print('bioshake_device.get_error_list(): ' + str(self._bsc.get_error_list()))
-                        self._debug_print('BioshakeError! Resetting for ' + str(self._config['setup_duration']) + 's and trying again...')
-                        self._bsc.reset_device()
-                        time.sleep(self._config['setup_duration'])
+                self._bioshake_command(self._bsc.shake_on,shake_speed)
+            self._status.update(shake_speed=shake_speed)
         return shake_speed
 
     def _shake_off(self,shake_speed):
         if self._using_bsc:
             if shake_speed != 0:
-                shook = False
-                shake_try = 0
-                while (not shook) and (shake_try < self._config['shake_attempts']):
-                    shake_try += 1
-                    try:
-                        self._bsc.shake_off()
-                        shook = True
-                    except BioshakeError:
-                        self._debug_print('bioshake_device.get_error_list(): ' + str(self._bsc.get_error_list()))
-                        self._debug_print('BioshakeError! Resetting for ' + str(self._config['setup_duration']) + 's and trying again...')
-                        self._bsc.reset_device()
-                        time.sleep(self._config['setup_duration'])
-                time.sleep(self._config['post_shake_off_duration'])
+                self._bioshake_command(self._bsc.shake_off)
+                self._status.update(shake_speed=0)
+                self._scheduler.wait(self._config['post_shake_off_duration'],'post shake off')
+
+    def _bioshake_command(self,command,*args):
+        '''
+        Run a bioshake_device command, recovering from BioshakeErrors.
+        Errors without device errors are retried once after a short
+        delay before escalating to a device reset, and after a reset
+        the device is polled until it has finished booting instead of
+        waiting the full setup_duration. A reset that fails counts as a
+        failed attempt. Gives up after shake_attempts resets.
+        '''
+        failures = 0
+        retried = False
+        recovery_start_time = None
+        error_class = None
+        while True:
+            try:
+                command(*args)
+                break
+            except BioshakeError:
+                if recovery_start_time is None:
+                    recovery_start_time = time.time()
+                error_class,error_list = self._classify_bioshake_error()
+                self._debug_print('BioshakeError! class: ' + error_class + ', bioshake_device.get_error_list(): ' + str(error_list))
+                if (error_class == 'transient') and (not retried):
+                    retried = True
+                    self._debug_print('Retrying in ' + str(BIOSHAKE_RETRY_DELAY) + 's...')
+                    time.sleep(BIOSHAKE_RETRY_DELAY)
+                    continue
+                failures += 1
+                try:
+                    self._bsc.reset_device()
+                except BioshakeError:
+                    self._debug_print('BioshakeError! bioshake_device.reset_device() failed.')
+                if failures >= self._config['shake_attempts']:
+                    # leave the device booted for the commands that follow
+                    self._debug_print('Waiting up to ' + str(self._config['setup_duration']) + 's for bioshake_device to boot...')
+                    self._wait_for_bioshake_ready()
+                    self._debug_print('BioshakeError! Giving up after ' + str(failures) + ' attempts.')
+                    self._record_bioshake_recovery(error_class,recovery_start_time,False)
+                    return False
+                self._debug_print('Waiting up to ' + str(self._config['setup_duration']) + 's for bioshake_device to boot and trying again...')
+                self._wait_for_bioshake_ready()
+        if recovery_start_time is not None:
+            self._record_bioshake_recovery(error_class,recovery_start_time,True)
+        return True
+
+    def _classify_bioshake_error(self):
+        try:
+            error_list = self._bsc.get_error_list()
+        except BioshakeError:
+            return 'unresponsive',None
+        if error_list:
+            return 'device',error_list
+        return 'transient',error_list
+
+    def _wait_for_bioshake_ready(self):
+        '''
+        Poll the shake state until the device answers with a state other
+        than booting. An empty reply, which a rebooting device sends
+        before it answers, and serial or unknown state errors count as
+        not ready yet. Returns False after setup_duration.
+        '''
+        ready_start_time = time.time()
+        while (time.time() - ready_start_time) < self._config['setup_duration']:
+            time.sleep(BIOSHAKE_POLL_PERIOD)
+            try:
+                shake_state = self._bsc.get_shake_state()['value']
+            except (BioshakeError,IOError,KeyError,TypeError):
+                continue
+            if shake_state not in [BIOSHAKE_SHAKE_STATE_NO_REPLY,BIOSHAKE_SHAKE_STATE_BOOTING]:
+                self._debug_print('bioshake_device ready after ' + str(round(time.time() - ready_start_time,1)) + 's')
+                return True
+        self._debug_print('bioshake_device not ready after ' + str(self._config['setup_duration']) + 's')
+        return False
+
+    def _record_bioshake_recovery(self,error_class,recovery_start_time,recovered):
+        self._bioshake_recoveries.append({'error_class': error_class,
+                                          'latency': time.time() - recovery_start_time,
+                                          'recovered': recovered,
+                                          })
+
+    def get_bioshake_recovery_stats(self):
+        '''
+        Returns a dict, keyed by error class, of bioshake_device recovery
+        counts and latency statistics in seconds.
+        '''
+        stats = {}
+        for recovery in self._bioshake_recoveries:
+            error_class_stats = stats.setdefault(recovery['error_class'],{'count': 0,
+                                                                          'recovered': 0,
+                                                                          'latencies': []})
+            error_class_stats['count'] += 1
+            if recovery['recovered']:
+                error_class_stats['recovered'] += 1
+            error_class_stats['latencies'].append(recovery['latency'])
+        for error_class_stats in stats.values():
+            latencies = error_class_stats.pop('latencies')
+            error_class_stats['latency_mean'] = numpy.mean(latencies)
+            error_class_stats['latency_median'] = numpy.median(latencies)
+            error_class_stats['latency_max'] = max(latencies)
+            error_class_stats['latency_total'] = sum(latencies)
+        return stats
+
+    def _set_phase(self,phase):
+        self._phase = phase
+        self._status.set_phase(phase)
 
     def _debug_print(self, *args):
         if self._debug:
@@ -343,6 +864,7 @@ class Hybridizer(object):
                 self._msc.set_channels_on(channels)
             except KeyError:
                 raise HybridizerError('Unknown valve: ' + str(valve_key) + '. Check yaml config file for errors.')
+        self._update_valves_on([valve_key],True)
 
     def _set_valves_on(self, valve_keys):
         if self._using_msc:
@@ -351,6 +873,7 @@ class Hybridizer(object):
                 self._msc.set_channels_on(channels)
             except KeyError:
                 raise HybridizerError('Unknown valve: ' + str(valve_key) + '. Check yaml config file for errors.')
+        self._update_valves_on(valve_keys,True)
 
     def _set_valve_off(self, valve_key):
         if self._using_msc:
@@ -360,6 +883,7 @@ class Hybridizer(object):
                 self._msc.set_channels_off(channels)
             except KeyError:
                 raise HybridizerError('Unknown valve: ' + str(valve_key) + '. Check yaml config file for errors.')
+        self._update_valves_on([valve_key],False)
 
     def _set_valves_off(self, valve_keys):
         if self._using_msc:
@@ -368,6 +892,14 @@ class Hybridizer(object):
                 self._msc.set_channels_off(channels)
             except KeyError:
                 raise HybridizerError('Unknown valve: ' + str(valve_key) + '. Check yaml config file for errors.')
+        self._update_valves_on(valve_keys,False)
+
+    def _update_valves_on(self,valve_keys,on):
+        if on:
+            self._valves_on.update(valve_keys)
+        else:
+            self._valves_on.difference_update(valve_keys)
+        self._status.update(valves_on=sorted(self._valves_on))
 
     def _set_all_valves_off(self):
         valve_keys = self._get_valves()
@@ -391,8 +923,19 @@ class Hybridizer(object):
                 time.sleep(FILTER_PERIOD)
             adc_values_filtered = numpy.median(adc_values,axis=0)
             adc_values_filtered = adc_values_filtered.astype(int)
+            self._update_status_adc_values(adc_values_filtered)
         return adc_values_filtered
 
+    def _update_status_adc_values(self,adc_values_filtered):
+        adc_values = {}
+        for valve_key in QUADS:
+            try:
+                ain = self._valves[valve_key]['analog_inputs']['low']
+                adc_values[valve_key] = int(adc_values_filtered[ain])
+            except (KeyError,IndexError,TypeError):
+                pass
+        self._status.update(adc_values=adc_values)
+
     def _dispense_volume(self,valve_keys,volume):
     #     if i > 0:
     #         dispense_shake_duration = self._config['inter_dispense_shake_duration']
@@ -409,44 +952,73 @@ class Hybridizer(object):
     #     self._debug_print('dispensing ' + chemical + ' into microplate for ' + str(self._config['dispense_duration']) + 's ' + str(i+1) + '/' + str(dispense_volume) + '...')
     #     time.sleep(self._config['dispense_duration'])
         self._set_valve_on('system')
+        self._set_phase('filling')
         self._debug_print('sleeping before cylinder fill for ' + str(self._config['pre_cylinder_fill_duration']) + 's.. ')
-        time.sleep(self._config['pre_cylinder_fill_duration'])
+        self._scheduler.wait(self._config['pre_cylinder_fill_duration'],'pre cylinder fill')
+        if isinstance(volume,(list,tuple)):
+            volumes = dict(zip(valve_keys,volume))
+        else:
+            volumes = dict((valve_key,volume) for valve_key in valve_keys)
+        if self._using_msc:
+            fill_valve_keys = [valve_key for valve_key in valve_keys if volumes[valve_key] <= self._config['volume_crossover']]
+        else:
+            fill_valve_keys = []
+        load_valve_keys = [valve_key for valve_key in valve_keys if valve_key not in fill_valve_keys]
         final_adc_values = None
         jumps_list = None
-        if self._using_msc and (volume <= self._config['volume_crossover']):
+        if len(fill_valve_keys) > 0:
             channels = []
             adc_value_goals = []
             ains = []
             jumps = {}
-            valve_keys_copy = copy.copy(valve_keys)
-            for valve_key in valve_keys:
+            valve_keys_copy = copy.copy(fill_valve_keys)
+            for valve_key in fill_valve_keys:
                 valve = self._valves[valve_key]
                 channels.append(valve['channel'])
-                adc_value_goal,ain = self._volume_to_adc_and_ain(valve_key,volume)
+                adc_value_goal,ain = self._volume_to_adc_and_ain(valve_key,volumes[valve_key])
                 adc_value_goals.append(adc_value_goal)
                 ains.append(ain)
                 jumps[valve_key] = 0
 
-            volume_goal_initial = volume - self._config['volume_threshold_initial']
-            fill_duration_initial_max = 0
-            fill_durations_initial = []
-            if volume_goal_initial >= self._config['volume_threshold_initial']/2:
-                for valve_key in valve_keys:
+            # valves with the same volume are filled together for the shortest of their initial fill durations
+            fill_durations_total = dict((valve_key,0) for valve_key in fill_valve_keys)
+            fill_fault_count = len(self._fill_faults)
+            fill_durations_initial = {}
+            for valve_key in fill_valve_keys:
+                volume_goal_initial = volumes[valve_key] - self._config['volume_threshold_initial']
+                if volume_goal_initial >= self._config['volume_threshold_initial']/2:
                     fill_duration_initial = self._volume_to_fill_duration(valve_key,volume_goal_initial)
-                    fill_durations_initial.append(fill_duration_initial)
-                fill_duration_initial_min = min(fill_durations_initial)
-                self._msc.set_channels_on_for(channels,fill_duration_initial_min)
+                    fill_durations_initial.setdefault(volumes[valve_key],[]).append((valve_key,fill_duration_initial))
+            # groups run one after another, so each is scaled from the all cylinders basis to its own valve count
+            for valve_volume in sorted(fill_durations_initial):
+                valve_fill_durations = fill_durations_initial[valve_volume]
+                fill_duration_initial_min = min([fill_duration for valve_key,fill_duration in valve_fill_durations])
+                initial_channels = [self._valves[valve_key]['channel'] for valve_key,fill_duration in valve_fill_durations]
+                fill_duration_initial = int(round(self._fill_duration_from_all_cylinders(fill_duration_initial_min,len(initial_channels))))
+                # learn from what the group was actually open for, in the same basis as the jumps
+                fill_duration_all_cylinders = self._fill_duration_to_all_cylinders(fill_duration_initial,len(initial_channels))
+                for valve_key,fill_duration in valve_fill_durations:
+                    fill_durations_total[valve_key] += fill_duration_all_cylinders
+                self._msc.set_channels_on_for(initial_channels,fill_duration_initial)
                 while not self._msc.are_all_set_fors_complete():
                     self._debug_print('Waiting...')
-                    time.sleep(0.5 + fill_duration_initial_min/1000)
+                    time.sleep(0.5 + fill_duration_initial/1000)
                 self._msc.remove_all_set_fors()
 
-            fill_duration_base = self._config['fill_duration_one_cylinder']
-            fill_duration_per_cylinder = (self._config['fill_duration_all_cylinders'] - self._config['fill_duration_one_cylinder'])//(len(channels)-1)
+            fill_jumps_max = self._config.get('fill_jumps_max',FILL_JUMPS_MAX)
+            fill_duration_max = self._config.get('fill_duration_max',FILL_DURATION_MAX)
+            fill_stall_jumps = self._config.get('fill_stall_jumps',FILL_STALL_JUMPS)
+            fill_stall_adc_delta = self._config.get('fill_stall_adc_delta',FILL_STALL_ADC_DELTA)
+            fill_start_time = time.time()
+            adc_values_best = {}
+            stall_jumps = {}
             while len(channels) > 0:
-                fill_duration = fill_duration_base + fill_duration_per_cylinder*(len(channels)-1)
+                fill_duration = int(round(self._get_jump_duration(len(channels))))
                 self._debug_print("Setting {0} valves on for {1}ms".format(valve_keys_copy,fill_duration))
                 self._msc.set_channels_on_for(channels,fill_duration)
+                fill_duration_all_cylinders = self._fill_duration_to_all_cylinders(fill_duration,len(channels))
+                for valve_key in valve_keys_copy:
+                    fill_durations_total[valve_key] += fill_duration_all_cylinders
                 while not self._msc.are_all_set_fors_complete():
                     self._debug_print('Waiting...')
                     time.sleep(fill_duration/1000)
@@ -457,34 +1029,86 @@ class Hybridizer(object):
                     index = ains.index(ain)
                     valve_key_copy = valve_keys_copy[index]
                     jumps[valve_key_copy] += 1
-                    if adc_values_filtered[ain] >= adc_value_goals[index]:
-                        channels.pop(index)
-                        adc_value_goals.pop(index)
-                        ains.pop(index)
-                        valve_keys_copy.pop(index)
+                    adc_value = adc_values_filtered[ain]
+                    fault = None
+                    if adc_value >= adc_value_goals[index]:
+                        pass
+                    elif jumps[valve_key_copy] >= fill_jumps_max:
+                        fault = 'jump limit of {0} reached'.format(fill_jumps_max)
+                    elif (time.time() - fill_start_time) >= fill_duration_max:
+                        fault = 'fill duration limit of {0}s reached'.format(fill_duration_max)
+                    else:
+                        if (valve_key_copy in adc_values_best) and (adc_value - adc_values_best[valve_key_copy] < fill_stall_adc_delta):
+                            stall_jumps[valve_key_copy] += 1
+                        else:
+                            adc_values_best[valve_key_copy] = adc_value
+                            stall_jumps[valve_key_copy] = 0
+                        if stall_jumps[valve_key_copy] >= fill_stall_jumps:
+                            fault = 'adc value stalled at {0} for {1} jumps'.format(adc_values_best[valve_key_copy],fill_stall_jumps)
+                        else:
+                            continue
+                    if fault is not None:
+                        self._report_fill_fault(valve_key_copy,fault,volumes[valve_key_copy],adc_value,adc_value_goals[index],jumps[valve_key_copy])
+                    channels.pop(index)
+                    adc_value_goals.pop(index)
+                    ains.pop(index)
+                    valve_keys_copy.pop(index)
             adc_values_filtered = self._get_adc_values_filtered()
             final_adc_values = []
             jumps_list = []
             for valve_key in valve_keys:
-                adc_value_goal,ain = self._volume_to_adc_and_ain(valve_key,volume)
-                adc_value = adc_values_filtered[ain]
-                final_adc_values.append(adc_value)
-                jumps_list.append(jumps[valve_key])
-                # volume = self._adc_to_volume_low(valve_key,adc_value)
-        else:
-            self._set_valves_on(valve_keys)
+                if valve_key in fill_valve_keys:
+                    adc_value_goal,ain = self._volume_to_adc_and_ain(valve_key,volumes[valve_key])
+                    final_adc_values.append(adc_values_filtered[ain])
+                    jumps_list.append(jumps[valve_key])
+                else:
+                    final_adc_values.append(None)
+                    jumps_list.append(None)
+            if self._adaptive_calibration is not None:
+                fault_valve_keys = [fill_fault['valve'] for fill_fault in self._fill_faults[fill_fault_count:]]
+                fill_volumes = {}
+                for valve_key,adc_value in zip(valve_keys,final_adc_values):
+                    if (valve_key in fill_valve_keys) and (valve_key not in fault_valve_keys):
+                        fill_volumes[valve_key] = adc_value
+                self._update_adaptive_calibration(fill_volumes,dict((valve_key,fill_durations_total[valve_key]) for valve_key in fill_volumes))
+            self._scheduler.resync('filling')
+        # fully loaded valves would share the system pressure with the fill loop, so they load after it
+        if len(load_valve_keys) > 0:
+            self._set_valves_on(load_valve_keys)
             self._debug_print('loading chemical into syringes for ' + str(self._config['load_duration_full']) + 's...')
-            time.sleep(self._config['load_duration_full'])
-            self._set_valves_off(valve_keys)
+            self._scheduler.wait(self._config['load_duration_full'],'loading')
+            self._set_valves_off(load_valve_keys)
         self._set_valve_off('system')
         self._debug_print('sleeping after cylinder fill for ' + str(self._config['post_cylinder_fill_duration']) + 's.. ')
-        time.sleep(self._config['post_cylinder_fill_duration'])
+        self._scheduler.wait(self._config['post_cylinder_fill_duration'],'post cylinder fill')
         self._set_valves_on(valve_keys)
+        self._set_phase('dispensing')
         self._debug_print('dispensing chemical into microplate for ' + str(self._config['dispense_duration_full']) + 's.. ')
-        time.sleep(self._config['dispense_duration_full'])
+        self._scheduler.wait(self._config['dispense_duration_full'],'dispensing')
         self._set_valves_off(valve_keys)
         return final_adc_values,jumps_list
 
+    def _report_fill_fault(self,valve_key,fault,volume,adc_value,adc_value_goal,jumps):
+        fill_fault = {'valve': valve_key,
+                      'fault': fault,
+                      'volume': volume,
+                      'adc_value': int(adc_value),
+                      'adc_value_goal': adc_value_goal,
+                      'jumps': jumps,
+                      'time': time.time(),
+                      }
+        self._fill_faults.append(fill_fault)
+        self._status.update(fill_faults=list(self._fill_faults))
+        self._debug_print('Fill fault! Stopped filling {0}: {1}'.format(valve_key,fault))
+
+    def get_fill_faults(self):
+        '''
+        Returns a list of the cylinders dropped from the fill loop by the
+        fill watchdog, each a dict with the valve, fault, volume, final
+        adc value, adc value goal, jumps and time.
+        '''
+        return list(self._fill_faults)
+
     def _volume_to_adc_and_ain(self,valve_key,volume):
         valve = self._valves[valve_key]
         if volume <= self._config['volume_crossover']:
@@ -494,18 +1118,57 @@ class Hybridizer(object):
         if volume > self._config['volume_max']:
             raise HybridizerError('Asking for volume greater than the max volume of {0}!'.format(self._config['volume_max']))
         if volume <= self._config['volume_crossover']:
-            poly = Polynomial(self._calibration[valve_key]['volume_to_adc_low'])
+            poly = self._polynomials[valve_key]['volume_to_adc_low']
             adc_value = int(round(poly(volume)))
             self._debug_print("valve: {0}, adc_value: {1}, ain: {2}".format(valve_key,adc_value,ain))
             return adc_value,ain
         else:
-            poly = Polynomial(self._calibration[valve_key]['volume_to_adc_high'])
+            poly = self._polynomials[valve_key]['volume_to_adc_high']
             adc_value = int(round(poly(volume)))
             self._debug_print("valve: {0}, adc_value: {1}, ain: {2}".format(valve_key,adc_value,ain))
             return adc_value,ain
 
+    def _adc_to_volume_low(self,valve_key,adc_value):
+        poly = self._polynomials[valve_key]['volume_to_adc_low']
+        volumes = [root.real for root in (poly - adc_value).roots() if abs(root.imag) < 1e-6]
+        volumes = [volume for volume in volumes if 0 <= volume <= self._config['volume_max']]
+        if len(volumes) == 0:
+            return None
+        return min(volumes)
+
+    def _get_jump_duration(self,cylinder_count):
+        '''
+        Returns how many ms cylinder_count cylinders have to be open to
+        fill each as much as all cylinders are filled in
+        fill_duration_all_cylinders ms, interpolated over all quads
+        between fill_duration_one_cylinder and fill_duration_all_cylinders.
+        '''
+        fill_duration_one = self._config['fill_duration_one_cylinder']
+        fill_duration_all = self._config['fill_duration_all_cylinders']
+        cylinder_count_all = len(QUADS)
+        if cylinder_count >= cylinder_count_all:
+            return fill_duration_all
+        return fill_duration_one + (fill_duration_all - fill_duration_one)*(cylinder_count - 1)/(cylinder_count_all - 1)
+
+    def _fill_duration_from_all_cylinders(self,fill_duration,cylinder_count):
+        '''
+        Returns how long cylinder_count cylinders have to be open to fill
+        each as much as all cylinders are filled in fill_duration ms, the
+        basis volume_to_fill_duration is calibrated on.
+        '''
+        return fill_duration*self._get_jump_duration(cylinder_count)/self._config['fill_duration_all_cylinders']
+
+    def _fill_duration_to_all_cylinders(self,fill_duration,cylinder_count):
+        '''
+        Returns how long all cylinders have to be open together to fill
+        each as much as cylinder_count cylinders are filled in
+        fill_duration ms, so fill loop jumps with different numbers of
+        valves open can be added up for adaptive calibration.
+        '''
+        return fill_duration*self._config['fill_duration_all_cylinders']/self._get_jump_duration(cylinder_count)
+
     def _volume_to_fill_duration(self,valve_key,volume):
-        poly = Polynomial(self._calibration[valve_key]['volume_to_fill_duration'])
+        poly = self._polynomials[valve_key]['volume_to_fill_duration']
         fill_duration = int(round(poly(volume)))
         return fill_duration
 
@@ -669,22 +1332,57 @@ def main(args=None):
         args = sys.argv[1:]
     parser = argparse.ArgumentParser()
     parser.add_argument("calibration_file_path", help="Path to yaml calibration file.")
-    parser.add_argument("config_file_path", help="Path to yaml config file.")
+    parser.add_argument("config_file_path", nargs='+', help="Path to yaml config file. Several config files are run one after another.")
     parser.add_argument('-d','--debug-msc',
                         help='Open mixed_signal_controller in debug mode.',
                         action='store_true')
+    parser.add_argument('-c','--cache-dir',
+                        help='Directory to cache parsed config and calibration files in.')
+    parser.add_argument('-s','--status-port',
+                        help='Serve the run status as json over http on this port.',
+                        type=int)
+    parser.add_argument('-a','--sensor-archive-dir',
+                        help='Directory to archive the filtered analog inputs in, sampled at 5Hz.')
+    parser.add_argument('-n','--sensor-archive-file-count-max',
+                        help='Number of sensor archive files to keep, the oldest are deleted. Overrides sensor_archive_file_count_max in the config file.',
+                        type=int)
+    parser.add_argument('-l','--adaptive-calibration-file',
+                        help='Path to yaml file to learn and save fill durations in, updated after every cylinder fill.')
+    parser.add_argument('-q','--queue-file',
+                        help='Path to yaml file to save the job queue in, so an interrupted queue can be resumed.')
+    parser.add_argument('-v','--validate',
+                        help='Only parse and validate the config and calibration files.',
+                        action='store_true')
 
     args = parser.parse_args()
     calibration_file_path = args.calibration_file_path
     print("Calibration File Path: {0}".format(calibration_file_path))
-    config_file_path = args.config_file_path
-    print("Config File Path: {0}".format(config_file_path))
+    config_file_paths = args.config_file_path
+    print("Config File Paths: {0}".format(config_file_paths))
     debug_msc = args.debug_msc
     print("Debug MSC: {0}".format(debug_msc))
+    cache_dir = args.cache_dir
+
+    if args.validate:
+        for config_file_path in config_file_paths:
+            files = load_files(calibration_file_path,config_file_path,cache_dir)
+            print("{0} is valid.".format(config_file_path))
+            if files['optimization'] is not None:
+                print("Protocol optimization: {0}".format(files['optimization']))
+        print("Config and calibration files are valid.")
+        return
 
     debug = True
-    hyb = Hybridizer(debug=debug,calibration_file_path=calibration_file_path,config_file_path=config_file_path,debug_msc=debug_msc)
-    hyb.run_protocol()
+    hyb = Hybridizer(debug=debug,calibration_file_path=calibration_file_path,config_file_path=config_file_paths[0],debug_msc=debug_msc,cache_dir=cache_dir,status_port=args.status_port,sensor_archive_dir=args.sensor_archive_dir,adaptive_calibration_file_path=args.adaptive_calibration_file,sensor_archive_file_count_max=args.sensor_archive_file_count_max)
+    if (len(config_file_paths) == 1) and (args.queue_file is None):
+        hyb.run_protocol()
+    else:
+        queue = HybridizerJobQueue(hyb,args.queue_file)
+        queued_config_file_paths = [job['config_file_path'] for job in queue.get_jobs() if job['state'] == 'pending']
+        for config_file_path in config_file_paths:
+            if os.path.abspath(config_file_path) not in queued_config_file_paths:
+                queue.add_job(config_file_path)
+        queue.run()
 
 
 # -----------------------------------------------------------------------------------------
@@ -0,0 +1,98 @@
+from __future__ import print_function, division
+import os
+import threading
+import time
+import yaml
+
+
+class HybridizerJobQueue(object):
+    '''
+    Runs protocol config files one after another on a single Hybridizer,
+    reusing its open device connections. Consecutive jobs skip the setup
+    sequence and the next job's first chemical is primed while the
+    current job finishes aspirating. When queue_file_path is given the
+    queue is saved there after every change and reloaded on
+    construction, so an interrupted queue resumes where it stopped.
+    Example Usage:
+
+    hyb = Hybridizer('example_calibration.yaml','example_config.yaml')
+    queue = HybridizerJobQueue(hyb,'queue.yaml')
+    queue.add_job('plate1_config.yaml')
+    queue.add_job('plate2_config.yaml')
+    queue.run()
+    '''
+
+    def __init__(self,hybridizer,queue_file_path=None):
+        self._hybridizer = hybridizer
+        self._queue_file_path = queue_file_path
+        self._lock = threading.Lock()
+        self._jobs = []
+        if (queue_file_path is not None) and os.path.exists(queue_file_path):
+            with open(queue_file_path,'r') as queue_stream:
+                self._jobs = yaml.safe_load(queue_stream) or []
+            for job in self._jobs:
+                if job['state'] == 'running':
+                    job['state'] = 'pending'
+
+    def add_job(self,config_file_path):
+        self._hybridizer.validate_config(config_file_path)
+        with self._lock:
+            self._jobs.append({'config_file_path': os.path.abspath(config_file_path),
+                               'state': 'pending',
+                               'start_time': None,
+                               'end_time': None,
+                               })
+            self._save()
+
+    def get_jobs(self):
+        with self._lock:
+            return [dict(job) for job in self._jobs]
+
+    def clear_finished_jobs(self):
+        with self._lock:
+            self._jobs = [job for job in self._jobs if job['state'] != 'finished']
+            self._save()
+
+    def run(self):
+        '''
+        Run pending jobs until none are left. Jobs added from another
+        thread while the queue is running are picked up as well. If a job
+        fails it is marked failed and the exception is raised, if it is
+        interrupted it is left pending.
+        '''
+        while True:
+            with self._lock:
+                pending_jobs = [job for job in self._jobs if job['state'] == 'pending']
+                if len(pending_jobs) == 0:
+                    break
+                job = pending_jobs[0]
+                next_config_file_path = None
+                if len(pending_jobs) > 1:
+                    next_config_file_path = pending_jobs[1]['config_file_path']
+                job['state'] = 'running'
+                job['start_time'] = time.time()
+                self._save()
+            try:
+                self._hybridizer.load_config(job['config_file_path'])
+                self._hybridizer.run_protocol(next_config_file_path=next_config_file_path)
+            except KeyboardInterrupt:
+                with self._lock:
+                    job['state'] = 'pending'
+                    job['start_time'] = None
+                    self._save()
+                raise
+            except:
+                with self._lock:
+                    job['state'] = 'failed'
+                    job['end_time'] = time.time()
+                    self._save()
+                raise
+            with self._lock:
+                job['state'] = 'finished'
+                job['end_time'] = time.time()
+                self._save()
+
+    def _save(self):
+        if self._queue_file_path is not None:
+            with open(self._queue_file_path,'w') as queue_stream:
+                yaml.safe_dump(self._jobs,queue_stream,default_flow_style=False)
@@ -0,0 +1,46 @@
+from __future__ import print_function, division
+import copy
+
+MERGE_IGNORED_KEYS = ['prime_count','repeat']
+
+
+def get_protocol_chemicals(protocol):
+    chemicals = []
+    for step in protocol:
+        if step['chemical'] not in chemicals:
+            chemicals.append(step['chemical'])
+    return chemicals
+
+def optimize_protocol(protocol,config):
+    '''
+    Returns a shorter equivalent of a defaults resolved protocol and a
+    report of what changed. Steps that use the same chemical as the step
+    before them are not primed again, and adjacent steps that only
+    differ in prime_count and repeat are merged into a single step with
+    repeats. The report also lists the manifold chemicals the protocol
+    never uses, which prime_system skips, and the seconds saved.
+    '''
+    prime_duration = config['prime_duration'] + config['prime_aspirate_duration']
+    primes_removed = 0
+    optimized = []
+    for step in protocol:
+        step = copy.copy(step)
+        if (len(optimized) > 0) and (optimized[-1]['chemical'] == step['chemical']):
+            primes_removed += step['prime_count']
+            step['prime_count'] = 0
+            previous_step = optimized[-1]
+            keys = set(previous_step.keys()) | set(step.keys())
+            if all(previous_step.get(key) == step.get(key) for key in keys if key not in MERGE_IGNORED_KEYS):
+                previous_step['repeat'] += step['repeat'] + 1
+                continue
+        optimized.append(step)
+    chemicals = get_protocol_chemicals(protocol)
+    chemicals_unused = [chemical for chemical in sorted(config['manifold'].keys())
+                        if (chemical not in chemicals) and (chemical not in ['aspirate','separate'])]
+    report = {'primes_removed': primes_removed,
+              'steps_merged': len(protocol) - len(optimized),
+              'chemicals_unused': chemicals_unused,
+              'seconds_saved': primes_removed*prime_duration,
+              'prime_system_seconds_saved': len(chemicals_unused)*config.get('system_prime_count',1)*prime_duration,
+              }
+    return optimized,report
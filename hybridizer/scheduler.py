@@ -0,0 +1,162 @@
+from __future__ import print_function, division
+import os
+import time
+import numpy
+
+
+def _get_clock_gettime_monotonic():
+    '''
+    Returns a monotonic clock function using clock_gettime through
+    ctypes, for Python 2.7 which has no time.monotonic, or None when
+    clock_gettime is not available.
+    '''
+    import ctypes
+    import ctypes.util
+    import sys
+    if sys.platform.startswith('linux'):
+        clock_id = 1
+    elif sys.platform == 'darwin':
+        clock_id = 6
+    else:
+        return None
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec',ctypes.c_long),
+                    ('tv_nsec',ctypes.c_long)]
+    for library_name in ['rt','c']:
+        library_path = ctypes.util.find_library(library_name)
+        if library_path is None:
+            continue
+        try:
+            clock_gettime = ctypes.CDLL(library_path,use_errno=True).clock_gettime
+        except (OSError,AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int,ctypes.POINTER(timespec)]
+        def clock_gettime_monotonic():
+            t = timespec()
+            if clock_gettime(clock_id,ctypes.byref(t)) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno,os.strerror(errno))
+            return t.tv_sec + t.tv_nsec*1e-9
+        try:
+            clock_gettime_monotonic()
+        except OSError:
+            continue
+        return clock_gettime_monotonic
+    return None
+
+# Python 2.7 has no time.monotonic, use the monotonic backport if it is
+# installed, then clock_gettime(CLOCK_MONOTONIC) and on Windows
+# time.clock, which counts from QueryPerformanceCounter. Only when none
+# of these exist is time.time used, and MONOTONIC is False, so a system
+# clock adjustment during a run would shift the schedule.
+MONOTONIC = True
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    try:
+        from monotonic import monotonic
+    except (ImportError,RuntimeError):
+        monotonic = _get_clock_gettime_monotonic()
+        if monotonic is None:
+            if os.name == 'nt':
+                monotonic = time.clock
+            else:
+                monotonic = time.time
+                MONOTONIC = False
+
+RESYNC_THRESHOLD = 1.0
+
+
+class DeadlineScheduler(object):
+    '''
+    Schedules protocol waits against absolute deadlines on the monotonic
+    clock. Each wait ends planned duration seconds after the previous
+    deadline rather than after the current time, so the latency of
+    serial commands and prints issued between waits is absorbed instead
+    of accumulating. When a wait starts more than resync_threshold
+    seconds late, or after feedback controlled work with no planned
+    duration, the schedule is moved to the current time and the delay is
+    counted as unplanned instead of being taken out of the next waits.
+    '''
+
+    def __init__(self,resync_threshold=RESYNC_THRESHOLD,clock=monotonic,sleep=None):
+        self._resync_threshold = resync_threshold
+        self._clock = clock
+        if sleep is None:
+            sleep = time.sleep
+        self._sleep = sleep
+        self.start()
+
+    def start(self):
+        self._start_time = self._clock()
+        self._deadline = self._start_time
+        self._planned = 0
+        self._phases = {}
+        self._unplanned = {}
+
+    def get_deadline(self):
+        return self._deadline
+
+    def wait(self,duration,phase):
+        if duration < 0:
+            duration = 0
+        now = self._clock()
+        if (now - self._deadline) > self._resync_threshold:
+            self._add_unplanned(phase,now - self._deadline)
+            self._deadline = now
+        self._deadline += duration
+        self._planned += duration
+        remaining = self._deadline - self._clock()
+        if remaining > 0:
+            self._sleep(remaining)
+        jitter = self._clock() - self._deadline
+        try:
+            phase_timing = self._phases[phase]
+        except KeyError:
+            phase_timing = self._phases[phase] = {'planned': 0,
+                                                  'jitters': []}
+        phase_timing['planned'] += duration
+        phase_timing['jitters'].append(jitter)
+
+    def resync(self,phase):
+        '''
+        Move the schedule to the current time after work that has no
+        planned duration, such as feedback controlled cylinder fills or
+        waiting for the temperature to settle.
+        '''
+        now = self._clock()
+        if now > self._deadline:
+            self._add_unplanned(phase,now - self._deadline)
+            self._deadline = now
+
+    def _add_unplanned(self,phase,duration):
+        self._unplanned[phase] = self._unplanned.get(phase,0) + duration
+
+    def get_report(self):
+        '''
+        Returns a dict with the planned, unplanned and actual elapsed
+        seconds, the cumulative drift from the plan not explained by
+        unplanned work, and per phase wait counts, planned seconds and
+        wake up jitter statistics in seconds. monotonic is False when
+        the schedule ran on time.time because no monotonic clock was
+        available.
+        '''
+        elapsed = self._clock() - self._start_time
+        unplanned = sum(self._unplanned.values())
+        phases = {}
+        for phase,phase_timing in self._phases.items():
+            jitters = numpy.array(phase_timing['jitters'])
+            phases[phase] = {'count': len(jitters),
+                             'planned': phase_timing['planned'],
+                             'jitter_mean': float(numpy.mean(jitters)),
+                             'jitter_max': float(numpy.max(jitters)),
+                             'jitter_std': float(numpy.std(jitters)),
+                             }
+        return {'planned': self._planned,
+                'unplanned': unplanned,
+                'unplanned_phases': dict(self._unplanned),
+                'elapsed': elapsed,
+                'drift': elapsed - self._planned - unplanned,
+                'phases': phases,
+                'monotonic': MONOTONIC,
+                }
@@ -0,0 +1,216 @@
+from __future__ import print_function, division
+import os
+import time
+import numpy
+import yaml
+
+INDEX_FILE_NAME = 'index.yaml'
+FILE_SIZE = 64*1024*1024
+FLUSH_PERIOD = 10
+
+
+def _get_dtype(channel_count):
+    return numpy.dtype([('time','<f8'),
+                        ('phase','<u2'),
+                        ('values','<i4',(channel_count,))])
+
+def _read_index(directory):
+    index_file_path = os.path.join(directory,INDEX_FILE_NAME)
+    if os.path.exists(index_file_path):
+        with open(index_file_path,'r') as index_stream:
+            index = yaml.safe_load(index_stream)
+        if index:
+            return index
+    return {'phases': [],
+            'files': []}
+
+def _write_index(directory,index):
+    index_file_path = os.path.join(directory,INDEX_FILE_NAME)
+    index_file_path_tmp = index_file_path + '.tmp'
+    with open(index_file_path_tmp,'w') as index_stream:
+        yaml.safe_dump(index,index_stream,default_flow_style=False)
+    if os.path.exists(index_file_path):
+        os.remove(index_file_path)
+    os.rename(index_file_path_tmp,index_file_path)
+
+
+class SensorArchiveWriter(object):
+    '''
+    Appends analog input frames, each with a timestamp and a phase
+    tag, to fixed size records in preallocated memory mapped files in
+    directory. A new file is started when the current one is full and
+    the oldest files beyond max_file_count are deleted, so memory and
+    disk use stay constant however long the archive runs.
+    '''
+
+    def __init__(self,directory,file_size=FILE_SIZE,max_file_count=None):
+        self._directory = directory
+        self._file_size = file_size
+        self._max_file_count = max_file_count
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._index = _read_index(directory)
+        self._phase_ids = dict((phase,phase_id) for phase_id,phase in enumerate(self._index['phases']))
+        self._records = None
+        self._record_n = 0
+        self._channel_count = None
+        self._flush_time = 0
+
+    def append(self,values,phase=None,timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        if self._records is None:
+            self._open_file(len(values))
+        elif self._record_n >= len(self._records):
+            self._open_file(self._channel_count)
+        record = self._records[self._record_n]
+        record['phase'] = self._get_phase_id(phase)
+        record['values'] = values
+        # time is written last, readers use it to find written records
+        record['time'] = timestamp
+        self._record_n += 1
+        if (timestamp - self._flush_time) >= FLUSH_PERIOD:
+            self.flush()
+
+    def flush(self):
+        if self._records is not None:
+            self._records.flush()
+        self._flush_time = time.time()
+
+    def close(self):
+        if self._records is not None:
+            self._records.flush()
+            self._records = None
+
+    def _get_phase_id(self,phase):
+        phase = str(phase)
+        try:
+            return self._phase_ids[phase]
+        except KeyError:
+            phase_id = len(self._index['phases'])
+            self._index['phases'].append(phase)
+            self._phase_ids[phase] = phase_id
+            _write_index(self._directory,self._index)
+            return phase_id
+
+    def _open_file(self,channel_count):
+        self.close()
+        self._channel_count = channel_count
+        dtype = _get_dtype(channel_count)
+        record_count = max(self._file_size//dtype.itemsize,1)
+        file_n = self._index.get('file_count',0)
+        self._index['file_count'] = file_n + 1
+        file_name = 'adc_{0}_{1:04d}.dat'.format(time.strftime("%Y%m%d-%H%M%S"),file_n)
+        self._records = numpy.memmap(os.path.join(self._directory,file_name),
+                                     dtype=dtype,
+                                     mode='w+',
+                                     shape=(record_count,))
+        self._record_n = 0
+        self._index['files'].append({'name': file_name,
+                                     'channel_count': channel_count,
+                                     'record_count': record_count,
+                                     })
+        if self._max_file_count is not None:
+            while len(self._index['files']) > self._max_file_count:
+                old_file = self._index['files'].pop(0)
+                try:
+                    os.remove(os.path.join(self._directory,old_file['name']))
+                except OSError:
+                    pass
+        _write_index(self._directory,self._index)
+
+
+class SensorArchive(object):
+    '''
+    Reads a directory written by SensorArchiveWriter. Queries return
+    lists of numpy record array views into the memory mapped files, one
+    per contiguous block of matching records, with the fields time,
+    phase and values, so even very large archives are not copied into
+    memory.
+    Example Usage:
+
+    archive = SensorArchive('sensor_archive')
+    for frames in archive.get_phase('filling'):
+        print(frames['time'],frames['values'][:,1])
+    '''
+
+    def __init__(self,directory):
+        self._directory = directory
+        self._index = None
+        self._files = {}
+        self.refresh()
+
+    def refresh(self):
+        '''
+        Reread the index, to pick up files and phases added since the
+        archive was opened.
+        '''
+        self._index = _read_index(self._directory)
+        file_names = [file_info['name'] for file_info in self._index['files']]
+        for file_name in list(self._files.keys()):
+            if file_name not in file_names:
+                del self._files[file_name]
+
+    def get_phases(self):
+        return list(self._index['phases'])
+
+    def _get_records(self,file_info):
+        try:
+            records = self._files[file_info['name']]
+        except KeyError:
+            records = numpy.memmap(os.path.join(self._directory,file_info['name']),
+                                   dtype=_get_dtype(file_info['channel_count']),
+                                   mode='r',
+                                   shape=(file_info['record_count'],))
+            self._files[file_info['name']] = records
+        # unwritten records are zero filled, find the first one
+        times = records['time']
+        record_count = 0
+        record_count_max = len(times)
+        while record_count < record_count_max:
+            record_n = (record_count + record_count_max)//2
+            if times[record_n] != 0:
+                record_count = record_n + 1
+            else:
+                record_count_max = record_n
+        return records[:record_count]
+
+    def _get_all_records(self):
+        all_records = []
+        for file_info in self._index['files']:
+            if os.path.exists(os.path.join(self._directory,file_info['name'])):
+                all_records.append(self._get_records(file_info))
+        return all_records
+
+    def get_time_range(self,start_time=None,end_time=None):
+        '''
+        Returns views of the frames with start_time <= time < end_time.
+        '''
+        views = []
+        for records in self._get_all_records():
+            times = records['time']
+            start = 0
+            end = len(records)
+            if start_time is not None:
+                start = numpy.searchsorted(times,start_time,side='left')
+            if end_time is not None:
+                end = numpy.searchsorted(times,end_time,side='left')
+            if end > start:
+                views.append(records[start:end])
+        return views
+
+    def get_phase(self,phase,start_time=None,end_time=None):
+        '''
+        Returns views of each contiguous block of frames tagged with phase.
+        '''
+        try:
+            phase_id = self._index['phases'].index(phase)
+        except ValueError:
+            return []
+        views = []
+        for records in self.get_time_range(start_time,end_time):
+            matches = numpy.concatenate(([False],records['phase'] == phase_id,[False]))
+            edges = numpy.flatnonzero(matches[1:] != matches[:-1])
+            for start,end in zip(edges[::2],edges[1::2]):
+                views.append(records[start:end])
+        return views
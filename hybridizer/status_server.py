@@ -0,0 +1,119 @@
+from __future__ import print_function, division
+import json
+import threading
+import time
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+
+class HybridizerStatus(object):
+    '''
+    Thread safe snapshot of the hybridizer run state. The control loop
+    only stores values under a lock, all formatting and serialization
+    happens in the thread reading the snapshot, so updating the status
+    never slows down the control loop.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._status = {'state': 'idle',
+                        'step': None,
+                        'step_count': None,
+                        'chemical': None,
+                        'run': None,
+                        'run_count': None,
+                        'phase': None,
+                        'phase_start_time': None,
+                        'valves_on': [],
+                        'adc_values': {},
+                        'fill_faults': [],
+                        'shake_speed': 0,
+                        'temperature_target': None,
+                        'temperature_actual': None,
+                        'protocol_start_time': None,
+                        'planned_end_time': None,
+                        }
+
+    def update(self,**kwargs):
+        with self._lock:
+            self._status.update(kwargs)
+
+    def set_phase(self,phase):
+        with self._lock:
+            self._status['phase'] = phase
+            self._status['phase_start_time'] = time.time()
+
+    def snapshot(self):
+        with self._lock:
+            status = dict(self._status)
+        now = time.time()
+        status['time'] = now
+        if status['protocol_start_time'] is not None:
+            status['elapsed'] = now - status['protocol_start_time']
+        else:
+            status['elapsed'] = None
+        if status['planned_end_time'] is not None:
+            status['eta'] = max(0,status['planned_end_time'] - now)
+        else:
+            status['eta'] = None
+        if status['phase_start_time'] is not None:
+            status['phase_elapsed'] = now - status['phase_start_time']
+        else:
+            status['phase_elapsed'] = None
+        return status
+
+
+class _StatusRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/','/status']:
+            self.send_error(404)
+            return
+        body = json.dumps(self.server.status.snapshot(),sort_keys=True).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(body)))
+        self.send_header('Cache-Control','no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,format,*args):
+        pass
+
+
+class _StatusHTTPServer(ThreadingMixIn,HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class StatusServer(object):
+    '''
+    Serves a HybridizerStatus snapshot as json over http from a daemon
+    thread, so a run can be monitored remotely, for example with:
+
+    curl http://hostname:port/status
+    '''
+
+    def __init__(self,status,host='',port=0):
+        self._server = _StatusHTTPServer((host,port),_StatusRequestHandler)
+        self._server.status = status
+        self._thread = None
+
+    def get_address(self):
+        return self._server.server_address
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._server.serve_forever)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()